@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import time
+import timeit
+
+import fire
+
+from header import CompactHeader, decode_header
+from protocol import Protocol_client
+
+
+def _report(name, n, seconds):
+    print('{:<24} {:>10.3f} us/op'.format(name, seconds / n * 1e6))
+
+
+def run(n=100000, data_size=16384):
+    """
+    Compares header serialization costs of the JSON and the compact format.
+    """
+    frame_header = {Protocol_client.JSON_KEY_FRAME_ID: '1234'}
+    result_header = {Protocol_client.JSON_KEY_FRAME_ID: 1234,
+                     Protocol_client.JSON_KEY_DATA_SIZE: data_size}
+    result_json = json.dumps(result_header)
+    result_compact = CompactHeader.from_dict(result_header)
+    # fields outside the fixed layout go through the extension area
+    result_compact_ext = CompactHeader.from_dict(
+        dict(result_header, **{Protocol_client.JSON_KEY_ENGINE_ID: 'lego'}))
+    now = time.time()
+
+    _report('json frame encode', n, timeit.timeit(
+        lambda: json.dumps(frame_header), number=n))
+    _report('compact frame encode', n, timeit.timeit(
+        lambda: CompactHeader.pack(1234, data_size, client_time=now),
+        number=n))
+    _report('json result decode', n, timeit.timeit(
+        lambda: decode_header(result_json), number=n))
+    _report('compact result decode', n, timeit.timeit(
+        lambda: decode_header(result_compact), number=n))
+    _report('compact ext decode', n, timeit.timeit(
+        lambda: decode_header(result_compact_ext), number=n))
+    print('header size: json {} bytes (+4 framing), compact {} bytes'.format(
+        len(result_json), len(result_compact)))
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import threading
+
+import numpy as np
+
+
+class BufferPool(object):
+    """
+    Thread-safe pool of reusable numpy arrays and bytearrays.
+
+    Arrays are pooled by shape and dtype. Bytearrays are pooled by capacity,
+    rounded up to the next power of two, so callers must only use the first
+    size bytes of what acquire_bytes returns. At most max_free released
+    buffers are kept per size, anything beyond that is left to the garbage
+    collector.
+    """
+
+    MIN_BYTES = 4096
+
+    def __init__(self, max_free=4):
+        super(BufferPool, self).__init__()
+        self.max_free = max_free
+        self.free = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.outstanding_bytes = 0
+        self.peak_outstanding_bytes = 0
+
+    @staticmethod
+    def _key(buf):
+        if isinstance(buf, np.ndarray):
+            return buf.shape, buf.dtype.str
+        return len(buf)
+
+    def _acquire(self, key, factory):
+        with self.lock:
+            free = self.free.get(key)
+            if free:
+                buf = free.pop()
+                self.hits += 1
+            else:
+                buf = None
+                self.misses += 1
+
+        if buf is None:
+            buf = factory()
+        nbytes = buf.nbytes if isinstance(buf, np.ndarray) else len(buf)
+        with self.lock:
+            self.outstanding_bytes += nbytes
+            self.peak_outstanding_bytes = max(self.peak_outstanding_bytes,
+                                              self.outstanding_bytes)
+        return buf
+
+    def acquire_array(self, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        return self._acquire((shape, dtype.str),
+                             lambda: np.empty(shape, dtype=dtype))
+
+    def acquire_bytes(self, size):
+        capacity = self.MIN_BYTES
+        while capacity < size:
+            capacity *= 2
+        return self._acquire(capacity, lambda: bytearray(capacity))
+
+    def release(self, buf):
+        key = BufferPool._key(buf)
+        nbytes = buf.nbytes if isinstance(buf, np.ndarray) else len(buf)
+        with self.lock:
+            self.outstanding_bytes -= nbytes
+            free = self.free[key]
+            if len(free) < self.max_free:
+                free.append(buf)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'free_buffers': sum(len(f) for f in self.free.values()),
+                'outstanding_bytes': self.outstanding_bytes,
+                'peak_outstanding_bytes': self.peak_outstanding_bytes,
+            }
@@ -6,6 +6,8 @@ import Queue
 import cv2
 import json
 import logging
+import multiprocessing
+import resource
 import select
 import struct
 import threading
@@ -14,10 +16,15 @@ from time import sleep
 
 import fire
 import logzero
+import numpy as np
 from logzero import logger
 
 import protocol
+from bufferpool import BufferPool
 from config import Config
+from dispatch import ResultDispatcher
+from framering import FrameRing
+from header import CompactHeader, HeaderNegotiator, decode_header
 from socketLib import ClientCommand, ClientReply, SocketClientThread
 
 
@@ -34,15 +41,21 @@ class GabrielSocketCommand(ClientCommand):
 class VideoCaptureThread(threading.Thread):
     """
     Thread tasked with capturing video from the camera at a fixed rate.
+
+    Frames are decoded into buffers from frame_pool. A frame obtained from
+    get_frame must be handed back with release_frame once it is no longer
+    needed; video_frame_callback must not keep a reference to its frame.
     """
 
     def __init__(self,
                  input_source,
                  fps=24,
-                 video_frame_callback=None):
+                 video_frame_callback=None,
+                 frame_pool=None):
         super(VideoCaptureThread, self).__init__()
         self.input_source = input_source
         self.video_frame_callback = video_frame_callback
+        self.frame_pool = frame_pool or BufferPool()
         self.alive = threading.Event()
         self.alive.set()
         self.frame_buf = Queue.Queue(maxsize=1)  # holds latest frame
@@ -51,11 +64,13 @@ class VideoCaptureThread(threading.Thread):
 
     def run(self):
         video_capture = cv2.VideoCapture(self.input_source)
+        frame_shape = None
         while self.alive.isSet():
             ti = time.time()
-            ret, frame = video_capture.read()
+            ret, frame = self._read_frame(video_capture, frame_shape)
 
             if ret:
+                frame_shape = frame.shape
                 if self.video_frame_callback:
                     self.video_frame_callback(frame)
                     # self.sig_feed.emit(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
@@ -71,17 +86,158 @@ class VideoCaptureThread(threading.Thread):
 
         video_capture.release()
 
+    def _read_frame(self, video_capture, frame_shape):
+        if frame_shape is None:
+            # the frame size is only known after the first read
+            ret, frame = video_capture.read()
+            if not ret:
+                return ret, None
+            buf = self.frame_pool.acquire_array(frame.shape, frame.dtype)
+            np.copyto(buf, frame)
+            return ret, buf
+
+        buf = self.frame_pool.acquire_array(frame_shape)
+        ret, frame = video_capture.read(buf)
+        if not ret:
+            self.frame_pool.release(buf)
+            return ret, None
+        if frame is not buf:
+            # capture backend did not decode in place
+            self.frame_pool.release(buf)
+            buf = self.frame_pool.acquire_array(frame.shape, frame.dtype)
+            np.copyto(buf, frame)
+        return ret, buf
+
     def _put_frame(self, frame):
         while True:
             try:
                 self.frame_buf.put(frame, block=False)
                 return
             except Queue.Full:
-                self.frame_buf.get()
+                self.release_frame(self.frame_buf.get()[1])
 
     def get_frame(self):
         return self.frame_buf.get(block=True)
 
+    def frame_valid(self):
+        # frames handed out by get_frame are not reused until released
+        return True
+
+    def release_frame(self, frame):
+        if frame is not None:
+            self.frame_pool.release(frame)
+
+    def join(self, timeout=None):
+        self.alive.clear()
+        threading.Thread.join(self, timeout)
+
+
+class VideoCaptureProcess(multiprocessing.Process):
+    """
+    Process tasked with capturing video from the camera at a fixed rate,
+    writing the frames straight into a shared FrameRing.
+    """
+
+    def __init__(self, input_source, ring, fps=24):
+        super(VideoCaptureProcess, self).__init__()
+        self.input_source = input_source
+        self.ring = ring
+        self.alive = multiprocessing.Event()
+        self.alive.set()
+        self.interval = 1.0 / float(fps)
+        self.daemon = True
+
+    @staticmethod
+    def probe_shape(input_source):
+        video_capture = cv2.VideoCapture(input_source)
+        ret, frame = video_capture.read()
+        video_capture.release()
+        if not ret:
+            raise IOError(
+                'Could not read a frame from {}'.format(input_source))
+        return frame.shape
+
+    def run(self):
+        video_capture = cv2.VideoCapture(self.input_source)
+        try:
+            while self.alive.is_set():
+                ti = time.time()
+                seq, slot = self.ring.begin_write()
+                ret, frame = video_capture.read(slot)
+
+                if not ret:
+                    logger.debug('No more video frames from {}'.format(
+                        self.input_source))
+                    break
+                if frame is not slot:
+                    # capture backend did not decode in place
+                    if frame.shape != slot.shape:
+                        logger.error('Frame shape changed to {}'.format(
+                            frame.shape))
+                        break
+                    np.copyto(slot, frame)
+
+                self.ring.commit(seq)
+                time.sleep(max(self.interval - (time.time() - ti), 0))
+        finally:
+            video_capture.release()
+            self.ring.close()
+
+    def join(self, timeout=None):
+        self.alive.clear()
+        multiprocessing.Process.join(self, timeout)
+
+
+class RingFrameReader(object):
+    """
+    Reads the latest frames from a FrameRing without copying them, with the
+    same get_frame interface as VideoCaptureThread.
+    """
+
+    def __init__(self, ring):
+        super(RingFrameReader, self).__init__()
+        self.ring = ring
+        self.seq = -1
+
+    def get_frame(self):
+        while True:
+            seq, frame = self.ring.read(self.seq, timeout=0.1)
+            if seq == -1:
+                return False, None
+            if seq is not None:
+                self.seq = seq
+                return True, frame
+
+    def frame_valid(self):
+        # the frame from the last get_frame may since have been overwritten
+        return self.ring.valid(self.seq)
+
+    def release_frame(self, frame):
+        # ring slots are reused by the writer, nothing to hand back
+        pass
+
+
+class RingPreviewThread(threading.Thread):
+    """
+    Thread feeding frames from a FrameRing to the video frame callback,
+    independently of the streaming thread.
+    """
+
+    def __init__(self, reader, video_frame_callback):
+        super(RingPreviewThread, self).__init__()
+        self.reader = reader
+        self.video_frame_callback = video_frame_callback
+        self.alive = threading.Event()
+        self.alive.set()
+        self.daemon = True
+
+    def run(self):
+        while self.alive.isSet():
+            ret, frame = self.reader.get_frame()
+            if not ret:
+                break
+            self.video_frame_callback(frame)
+
     def join(self, timeout=None):
         self.alive.clear()
         threading.Thread.join(self, timeout)
@@ -89,11 +245,14 @@ class VideoCaptureThread(threading.Thread):
 
 class VideoStreamingThread(SocketClientThread):
     def __init__(self, video_capture,
-                 cmd_q=None, reply_q=None):
-        super(VideoStreamingThread, self).__init__(cmd_q, reply_q)
+                 cmd_q=None, reply_q=None, negotiator=None,
+                 buffer_pool=None):
+        super(VideoStreamingThread, self).__init__(cmd_q, reply_q,
+                                                   buffer_pool=buffer_pool)
         self.handlers[GabrielSocketCommand.STREAM] = self._handle_STREAM
         self.is_streaming = False
         self.video_capture = video_capture
+        self.negotiator = negotiator or HeaderNegotiator()
 
     def run(self):
         while self.alive.isSet():
@@ -111,25 +270,51 @@ class VideoStreamingThread(SocketClientThread):
         while self.alive.isSet() and self.is_streaming:
             # will be put into sleep if token is not available
             tokenm.getToken()
-            ret, frame = self.video_capture.get_frame()
-            if not ret:
+            jpeg_frame = self._encode_next_frame()
+            if jpeg_frame is None:
                 break
-            ret, jpeg_frame = cv2.imencode('.jpg', frame)
-            header = {protocol.Protocol_client.JSON_KEY_FRAME_ID: str(id)}
-            header_json = json.dumps(header)
-            self._handle_SEND(ClientCommand(ClientCommand.SEND, header_json))
-            self._handle_SEND(ClientCommand(
-                ClientCommand.SEND, jpeg_frame.tostring()))
+            if self.negotiator.use_compact():
+                # header and payload travel in a single message
+                header = CompactHeader.pack(id, jpeg_frame.nbytes,
+                                            client_time=time.time())
+                self._handle_SEND(ClientCommand(ClientCommand.SEND,
+                                                (header, jpeg_frame)))
+            else:
+                header = self.negotiator.offer(
+                    {protocol.Protocol_client.JSON_KEY_FRAME_ID: str(id)})
+                header_json = json.dumps(header)
+                self._handle_SEND(ClientCommand(ClientCommand.SEND,
+                                                header_json))
+                self._handle_SEND(ClientCommand(ClientCommand.SEND,
+                                                jpeg_frame))
             logger.debug('Send Frame {}'.format(id))
             id += 1
 
+    def _encode_next_frame(self):
+        while True:
+            ret, frame = self.video_capture.get_frame()
+            if not ret:
+                return None
+            ret, jpeg_frame = cv2.imencode('.jpg', frame)
+            valid = self.video_capture.frame_valid()
+            self.video_capture.release_frame(frame)
+            if valid:
+                return jpeg_frame
+            logger.debug('Frame overwritten while encoding, retrying')
+
 
 class ResultReceivingThread(SocketClientThread):
-    def __init__(self, cmd_q=None, reply_q=None, legacy=Config.LEGACY):
-        super(ResultReceivingThread, self).__init__(cmd_q, reply_q)
+    def __init__(self, cmd_q=None, reply_q=None, legacy=Config.LEGACY,
+                 negotiator=None, buffer_pool=None):
+        super(ResultReceivingThread, self).__init__(cmd_q, reply_q,
+                                                    buffer_pool=buffer_pool)
+        # results must not be dropped here, a full reply_q holds back the
+        # receiver instead
+        self.block_on_full_reply_q = True
         self.handlers[GabrielSocketCommand.LISTEN] = self._handle_LISTEN
         self.is_listening = False
         self.legacy = legacy
+        self.negotiator = negotiator or HeaderNegotiator()
 
     def run(self):
         while self.alive.isSet():
@@ -157,13 +342,16 @@ class ResultReceivingThread(SocketClientThread):
     def _recv_gabriel_data(self):
         header_size = struct.unpack("!I", self._recv_n_bytes(4))[0]
         header = self._recv_n_bytes(header_size)
-        header_json = json.loads(header)
         if self.legacy:
+            header_json = json.loads(header)
             data = header_json.pop('result')
         else:
-            data_size = header_json['data_size']
+            header_json = decode_header(header)
+            self.negotiator.observe(header, header_json)
+            data_size = header_json[
+                protocol.Protocol_client.JSON_KEY_DATA_SIZE]
             data = self._recv_n_bytes(data_size)
-        return (header, data)
+        return (header_json, data)
 
 
 class TokenManager(object):
@@ -210,7 +398,14 @@ class Client(object):
                  legacy=Config.LEGACY,
                  video_port=Config.VIDEO_STREAM_PORT,
                  result_port=Config.RESULT_RECEIVING_PORT,
-                 num_tokens=Config.TOKEN
+                 num_tokens=Config.TOKEN,
+                 compact_header=Config.COMPACT_HEADER,
+                 dispatch_workers=Config.DISPATCH_WORKERS,
+                 dispatch_queue_size=Config.DISPATCH_QUEUE_SIZE,
+                 dispatch_policy=Config.DISPATCH_POLICY,
+                 dispatch_ordered=Config.DISPATCH_ORDERED,
+                 capture_process=Config.CAPTURE_PROCESS,
+                 ring_slots=Config.FRAME_RING_SLOTS
                  ):
         super(self.__class__, self).__init__()
         self.ip = ip
@@ -219,12 +414,32 @@ class Client(object):
         self.video_port = video_port
         self.result_port = result_port
         self.token_mgr = TokenManager(num_tokens)
+        self.capture_process = capture_process
+        self.ring_slots = ring_slots
+        # the compact header is only defined for the non-legacy protocol
+        self.header_negotiator = HeaderNegotiator(
+            enabled=compact_header and not legacy)
+        self.dispatcher = ResultDispatcher(
+            lambda data: self.process_response(Client.parse(data)),
+            deliver=self.response_callback,
+            workers=dispatch_workers,
+            maxsize=dispatch_queue_size,
+            policy=dispatch_policy,
+            ordered=dispatch_ordered)
+        self.frame_pool = BufferPool()
+        self.socket_pool = BufferPool()
 
     def video_frame_callback(self, frame):
         # no-op by default
         logger.info('Superclass...')
         pass
 
+    def process_response(self, resp_dict):
+        # runs in parallel on the dispatch workers; the return value is
+        # passed to response_callback, in frame_id order if dispatch is
+        # ordered
+        return resp_dict
+
     def response_callback(self, resp_dict):
         instruction = resp_dict.get('speech', False)
         if instruction and len(instruction > 0):
@@ -237,6 +452,25 @@ class Client(object):
         else:
             return data
 
+    @staticmethod
+    def frame_id(header):
+        try:
+            return int(header[protocol.Protocol_client.JSON_KEY_FRAME_ID])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def dispatch_stats(self):
+        return self.dispatcher.stats()
+
+    def memory_stats(self):
+        return {
+            'frame_pool': self.frame_pool.stats(),
+            'socket_pool': self.socket_pool.stats(),
+            'dispatch': self.dispatcher.stats(),
+            # kilobytes on Linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
     def connect_and_run(self):
         logger.debug(
             "Connecting to Server ({}) Port ({}, {})".format(self.ip,
@@ -244,13 +478,29 @@ class Client(object):
                                                              self.result_port))
 
         # create the video threads
-        stream_cmd_q = Queue.Queue()
-        video_capture_thread = VideoCaptureThread(
-            self.video_input,
-            video_frame_callback=self.video_frame_callback
-        )
-        video_streaming_thread = VideoStreamingThread(video_capture_thread,
-                                                      cmd_q=stream_cmd_q)
+        stream_cmd_q = Queue.Queue(maxsize=SocketClientThread.QUEUE_SIZE)
+        preview_thread = None
+        if self.capture_process:
+            # capture runs in its own process and shares frames through a
+            # ring in shared memory, read by the streaming and preview
+            # threads
+            ring = FrameRing(
+                VideoCaptureProcess.probe_shape(self.video_input),
+                slots=self.ring_slots)
+            video_capture_thread = VideoCaptureProcess(self.video_input, ring)
+            frame_source = RingFrameReader(ring)
+            preview_thread = RingPreviewThread(RingFrameReader(ring),
+                                               self.video_frame_callback)
+        else:
+            video_capture_thread = VideoCaptureThread(
+                self.video_input,
+                video_frame_callback=self.video_frame_callback,
+                frame_pool=self.frame_pool
+            )
+            frame_source = video_capture_thread
+        video_streaming_thread = VideoStreamingThread(
+            frame_source, cmd_q=stream_cmd_q,
+            negotiator=self.header_negotiator, buffer_pool=self.socket_pool)
         video_streaming_thread.daemon = True
 
         # connect and stream to server
@@ -260,10 +510,14 @@ class Client(object):
                                        self.token_mgr))
 
         # create listening threads
-        result_cmd_q = Queue.Queue()
-        result_reply_q = Queue.Queue()
+        result_cmd_q = Queue.Queue(maxsize=SocketClientThread.QUEUE_SIZE)
+        # the dispatcher holds the backlog; keeping this queue short lets a
+        # blocking dispatch policy hold back the receiver, and thus the
+        # tokens
+        result_reply_q = Queue.Queue(maxsize=1)
         result_receiving_thread = ResultReceivingThread(
-            cmd_q=result_cmd_q, reply_q=result_reply_q, legacy=self.legacy)
+            cmd_q=result_cmd_q, reply_q=result_reply_q, legacy=self.legacy,
+            negotiator=self.header_negotiator, buffer_pool=self.socket_pool)
         result_receiving_thread.daemon = True
 
         result_cmd_q.put(ClientCommand(ClientCommand.CONNECT,
@@ -271,7 +525,10 @@ class Client(object):
         result_cmd_q.put(ClientCommand(GabrielSocketCommand.LISTEN,
                                        self.token_mgr))
 
+        self.dispatcher.start()
         video_capture_thread.start()
+        if preview_thread:
+            preview_thread.start()
         result_receiving_thread.start()
         sleep(0.1)
         video_streaming_thread.start()
@@ -280,6 +537,10 @@ class Client(object):
             video_streaming_thread.join()
             result_receiving_thread.join()
             video_capture_thread.join()
+            if preview_thread:
+                preview_thread.join()
+            self.dispatcher.stop()
+            logger.info('Memory stats: {}'.format(self.memory_stats()))
             with self.token_mgr.has_token_cv:
                 self.token_mgr.has_token_cv.notifyAll()
 
@@ -290,9 +551,9 @@ class Client(object):
                 # data attached
                 if resp.type == ClientReply.SUCCESS and resp.data is not None:
                     (resp_header, resp_data) = resp.data
-                    resp_header = json.loads(resp_header)
                     logger.debug('header: {}'.format(resp_header))
-                    self.response_callback(Client.parse(resp_data))
+                    self.dispatcher.submit(resp_data,
+                                           key=Client.frame_id(resp_header))
 
                 elif resp.type == ClientReply.ERROR:
                     logger.error("Error: {}".format(resp.data))
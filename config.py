@@ -7,3 +7,10 @@ class Config(object):
     VIDEO_STREAM_PORT = 9098
     RESULT_RECEIVING_PORT = 9111
     TOKEN = 1
+    COMPACT_HEADER = False
+    DISPATCH_WORKERS = 2
+    DISPATCH_QUEUE_SIZE = 4
+    DISPATCH_POLICY = 'drop-oldest'  # or 'coalesce', 'block'
+    DISPATCH_ORDERED = True
+    CAPTURE_PROCESS = False
+    FRAME_RING_SLOTS = 4
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import threading
+
+from logzero import logger
+
+
+class OverflowPolicy(object):
+    """ What ResultDispatcher.submit does when its queue is full.
+
+        DROP_OLDEST:    discard the oldest pending result
+        COALESCE:       discard every pending result, keeping only the newest
+        BLOCK:          wait until a worker frees a slot
+    """
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+    BLOCK = 'block'
+    POLICIES = [DROP_OLDEST, COALESCE, BLOCK]
+
+
+class ResultDispatcher(object):
+    """
+    Runs result callbacks on a pool of worker threads fed from a bounded
+    queue.
+
+    Each result goes through two stages: process(data), run in parallel on
+    the workers, and deliver(processed), which for an ordered dispatcher is
+    called one result at a time in submission order. Results whose key
+    (the frame_id) is lower than that of an already delivered result are
+    discarded as stale, so ordered consumers see frame_ids increasing.
+    """
+
+    _SKIP = object()
+
+    def __init__(self, process, deliver=None, workers=1, maxsize=1,
+                 policy=OverflowPolicy.DROP_OLDEST, ordered=True):
+        super(ResultDispatcher, self).__init__()
+        if policy not in OverflowPolicy.POLICIES:
+            raise ValueError('Unknown overflow policy {}'.format(policy))
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+
+        self.process = process
+        self.deliver = deliver
+        self.maxsize = maxsize
+        self.policy = policy
+        self.ordered = ordered
+
+        self.alive = threading.Event()
+        self.alive.set()
+
+        # pending (seq, key, data) tuples and sequence numbers of dropped
+        # results, guarded by queue_cv
+        self.pending = collections.deque()
+        self.dropped_seqs = set()
+        self.queue_cv = threading.Condition(threading.Lock())
+        self.next_seq = 0
+
+        # reorder buffer, guarded by deliver_lock. deliver_lock may be held
+        # while taking queue_cv, never the other way around.
+        self.deliver_lock = threading.Lock()
+        self.completed = {}
+        self.next_deliver_seq = 0
+        self.last_key = None
+
+        # stale and delivered are guarded by stats_lock, the others by queue_cv
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.stale = 0
+        self.delivered = 0
+        self.peak_depth = 0
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='ResultDispatcher-{}'.format(i))
+            worker.daemon = True
+            self.workers.append(worker)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout=None):
+        self.alive.clear()
+        with self.queue_cv:
+            self.queue_cv.notifyAll()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join(timeout)
+        logger.debug('ResultDispatcher stats: {}'.format(self.stats()))
+
+    def depth(self):
+        with self.queue_cv:
+            return len(self.pending)
+
+    def stats(self):
+        with self.queue_cv, self.stats_lock:
+            return {
+                'depth': len(self.pending),
+                'peak_depth': self.peak_depth,
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'stale': self.stale,
+                'delivered': self.delivered,
+            }
+
+    def submit(self, data, key=None):
+        """ Queues a result, applying the overflow policy if the queue is
+            full. Returns False if the dispatcher was stopped while waiting.
+        """
+        with self.queue_cv:
+            if self.policy == OverflowPolicy.BLOCK:
+                while len(self.pending) >= self.maxsize:
+                    if not self.alive.isSet():
+                        return False
+                    self.queue_cv.wait(0.1)
+            elif self.policy == OverflowPolicy.COALESCE:
+                while self.pending:
+                    self._drop_oldest()
+            else:
+                while len(self.pending) >= self.maxsize:
+                    self._drop_oldest()
+
+            self.pending.append((self.next_seq, key, data))
+            self.next_seq += 1
+            self.submitted += 1
+            self.peak_depth = max(self.peak_depth, len(self.pending))
+            self.queue_cv.notify()
+        return True
+
+    def _drop_oldest(self):
+        # called with queue_cv held
+        seq, _, _ = self.pending.popleft()
+        self.dropped += 1
+        if self.ordered:
+            self.dropped_seqs.add(seq)
+
+    def _take(self):
+        with self.queue_cv:
+            while not self.pending:
+                if not self.alive.isSet():
+                    return None
+                self.queue_cv.wait(0.1)
+            item = self.pending.popleft()
+            # wake up a submitter blocked on a full queue
+            self.queue_cv.notifyAll()
+            return item
+
+    def _work(self):
+        while self.alive.isSet():
+            item = self._take()
+            if item is None:
+                break
+            seq, key, data = item
+            try:
+                result = self.process(data)
+            except Exception as e:
+                logger.exception('Result callback failed: {}'.format(e))
+                result = self._SKIP
+
+            if self.ordered:
+                self._deliver_in_order(seq, key, result)
+            elif result is not self._SKIP:
+                self._deliver(result)
+
+    def _deliver_in_order(self, seq, key, result):
+        with self.deliver_lock:
+            self.completed[seq] = (key, result)
+            while True:
+                seq = self.next_deliver_seq
+                if seq in self.completed:
+                    entry = self.completed.pop(seq)
+                else:
+                    with self.queue_cv:
+                        if seq not in self.dropped_seqs:
+                            break
+                        self.dropped_seqs.remove(seq)
+                    entry = self._SKIP
+                self.next_deliver_seq += 1
+                if entry is self._SKIP or entry[1] is self._SKIP:
+                    continue
+
+                key, result = entry
+                if key is not None:
+                    if self.last_key is not None and key < self.last_key:
+                        with self.stats_lock:
+                            self.stale += 1
+                        continue
+                    self.last_key = key
+                self._deliver(result)
+
+    def _deliver(self, result):
+        try:
+            if self.deliver:
+                self.deliver(result)
+        except Exception as e:
+            logger.exception('Result delivery failed: {}'.format(e))
+        with self.stats_lock:
+            self.delivered += 1
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+
+class FrameRing(object):
+    """
+    Ring of preallocated frame slots in shared memory, written by a single
+    capture process and read zero-copy by any number of readers.
+
+    Frames are addressed by a monotonically increasing sequence number; the
+    frame with sequence number seq lives in slot seq % slots. A slot is
+    marked invalid while it is being written, so readers holding a view can
+    check with valid(seq) whether the frame was overwritten under them.
+
+    The ring must be created before the reader and writer processes are
+    forked.
+    """
+
+    def __init__(self, shape, slots=4, dtype=np.uint8):
+        super(FrameRing, self).__init__()
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+
+        slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._buf = multiprocessing.RawArray(ctypes.c_uint8,
+                                             slots * slot_bytes)
+        self.frames = np.frombuffer(self._buf, dtype=self.dtype).reshape(
+            (slots,) + self.shape)
+
+        # sequence number held by each slot, -1 while empty or being written
+        self.slot_seq = multiprocessing.RawArray(ctypes.c_longlong, slots)
+        for i in range(slots):
+            self.slot_seq[i] = -1
+
+        self.latest = multiprocessing.RawValue(ctypes.c_longlong, -1)
+        self.closed = multiprocessing.Event()
+        self.cv = multiprocessing.Condition()
+
+    def begin_write(self):
+        """ Returns the next sequence number and the slot to fill in. """
+        seq = self.latest.value + 1
+        slot = seq % self.slots
+        self.slot_seq[slot] = -1
+        return seq, self.frames[slot]
+
+    def commit(self, seq):
+        """ Publishes the frame written into the slot of seq. """
+        with self.cv:
+            self.slot_seq[seq % self.slots] = seq
+            self.latest.value = seq
+            self.cv.notify_all()
+
+    def write(self, frame):
+        seq, slot = self.begin_write()
+        if frame.shape != self.shape:
+            raise ValueError('Frame shape {} does not match ring shape '
+                             '{}'.format(frame.shape, self.shape))
+        np.copyto(slot, frame)
+        self.commit(seq)
+        return seq
+
+    def close(self):
+        with self.cv:
+            self.closed.set()
+            self.cv.notify_all()
+
+    def read(self, after=-1, timeout=None):
+        """ Waits for a frame newer than sequence number after and returns
+            (seq, view) for the latest one. Returns (None, None) on timeout
+            and (-1, None) once the writer has closed the ring.
+        """
+        with self.cv:
+            if self.latest.value <= after and not self.closed.is_set():
+                self.cv.wait(timeout)
+            seq = self.latest.value
+            if seq <= after:
+                if self.closed.is_set():
+                    return -1, None
+                return None, None
+        return seq, self.frames[seq % self.slots]
+
+    def valid(self, seq):
+        return self.slot_seq[seq % self.slots] == seq
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import struct
+import threading
+
+from protocol import Protocol_client
+
+
+class CompactHeader(object):
+    """ Fixed-layout binary header, used in place of the JSON header in the
+        non-legacy protocol once both ends have agreed on it.
+
+        Layout (network byte order):
+
+        magic:          2 bytes, never a valid first byte of a JSON object
+        version:        unsigned char
+        flags:          unsigned char, reserved
+        frame_id:       unsigned long long
+        client_time:    double, seconds since epoch, 0.0 if unset
+        server_time:    double, seconds since epoch, 0.0 if unset
+        data_size:      unsigned int, size of the payload following the header
+        ext_size:       unsigned short, size of the extension area
+
+        The extension area holds any remaining header fields as a JSON object
+        and is empty for the common case.
+    """
+    MAGIC = b'\xa7G'
+    VERSION = 1
+    FORMAT = 'compact-v1'
+    STRUCT = struct.Struct('!2sBBQddIH')
+    SIZE = STRUCT.size
+
+    FIXED_KEYS = (Protocol_client.JSON_KEY_FRAME_ID,
+                  Protocol_client.JSON_KEY_CLIENT_TIME,
+                  Protocol_client.JSON_KEY_SERVER_TIME,
+                  Protocol_client.JSON_KEY_DATA_SIZE)
+
+    @staticmethod
+    def is_compact(header):
+        return header[:2] == CompactHeader.MAGIC
+
+    @staticmethod
+    def pack(frame_id, data_size, client_time=0.0, server_time=0.0,
+             ext=None):
+        ext_data = json.dumps(ext) if ext else b''
+        return CompactHeader.STRUCT.pack(
+            CompactHeader.MAGIC, CompactHeader.VERSION, 0, int(frame_id),
+            client_time, server_time, data_size, len(ext_data)) + ext_data
+
+    @staticmethod
+    def unpack(header):
+        """ Decodes a compact header into the same dict the JSON header would
+            have produced. Unset timestamps are left out.
+        """
+        (magic, version, flags, frame_id, client_time, server_time,
+         data_size, ext_size) = CompactHeader.STRUCT.unpack_from(header)
+        if magic != CompactHeader.MAGIC or version != CompactHeader.VERSION:
+            raise ValueError(
+                'Unsupported compact header version {}'.format(version))
+
+        if ext_size > 0:
+            start = CompactHeader.SIZE
+            header_dict = json.loads(header[start:start + ext_size])
+        else:
+            header_dict = {}
+        header_dict[Protocol_client.JSON_KEY_FRAME_ID] = frame_id
+        header_dict[Protocol_client.JSON_KEY_DATA_SIZE] = data_size
+        if client_time:
+            header_dict[Protocol_client.JSON_KEY_CLIENT_TIME] = client_time
+        if server_time:
+            header_dict[Protocol_client.JSON_KEY_SERVER_TIME] = server_time
+        return header_dict
+
+    @staticmethod
+    def from_dict(header_dict):
+        ext = dict((k, v) for k, v in header_dict.items()
+                   if k not in CompactHeader.FIXED_KEYS)
+        return CompactHeader.pack(
+            header_dict[Protocol_client.JSON_KEY_FRAME_ID],
+            header_dict.get(Protocol_client.JSON_KEY_DATA_SIZE, 0),
+            header_dict.get(Protocol_client.JSON_KEY_CLIENT_TIME, 0.0),
+            header_dict.get(Protocol_client.JSON_KEY_SERVER_TIME, 0.0),
+            ext=ext)
+
+
+def decode_header(header):
+    """ Decodes a result header in either the compact or the JSON format. """
+    if CompactHeader.is_compact(header):
+        return CompactHeader.unpack(header)
+    return json.loads(header)
+
+
+class HeaderNegotiator(object):
+    """ Shared between the streaming and the receiving thread to agree on the
+        header format. Frames are sent with JSON headers carrying an offer for
+        the compact format until the server answers with a compact header or
+        echoes the offer back; servers that ignore the offer keep receiving
+        JSON headers.
+    """
+
+    def __init__(self, enabled=False):
+        super(HeaderNegotiator, self).__init__()
+        self.enabled = enabled
+        self.accepted = threading.Event()
+
+    def offer(self, header_dict):
+        if self.enabled:
+            header_dict[Protocol_client.JSON_KEY_HEADER_FORMAT] = \
+                CompactHeader.FORMAT
+        return header_dict
+
+    def use_compact(self):
+        return self.enabled and self.accepted.isSet()
+
+    def observe(self, raw_header, header_dict):
+        if not self.enabled or self.accepted.isSet():
+            return
+        if CompactHeader.is_compact(raw_header) or header_dict.get(
+                Protocol_client.JSON_KEY_HEADER_FORMAT) == CompactHeader.FORMAT:
+            self.accepted.set()
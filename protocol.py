@@ -25,6 +25,10 @@ class Protocol_client(object):
     JSON_KEY_FRAME_ID = "frame_id"
     JSON_KEY_ENGINE_ID = "engine_id"
     JSON_KEY_TOKEN_INJECT = "token_inject"
+    JSON_KEY_DATA_SIZE = "data_size"
+    JSON_KEY_HEADER_FORMAT = "header_format"
+    JSON_KEY_CLIENT_TIME = "client_time"
+    JSON_KEY_SERVER_TIME = "server_time"
 
 
 class Protocol_application(object):
@@ -13,15 +13,19 @@ import sys
 import threading
 from time import sleep
 
+import numpy as np
 from logzero import logger
 
+from bufferpool import BufferPool
+
 
 class ClientCommand(object):
     """ A command to the client thread.
         Each command type has its associated data:
 
         CONNECT:    (host, port) tuple
-        SEND:       Data string
+        SEND:       Data string, or a tuple of data strings and numpy
+                    arrays sent as a single message
         RECEIVE:    None
         CLOSE:      None
     """
@@ -52,12 +56,20 @@ class SocketClientThread(threading.Thread):
     """ Implements the threading.Thread interface (start, join, etc.) and
         can be controlled via the cmd_q Queue attribute. Replies are
         placed in the reply_q Queue attribute.
+
+        Both queues are bounded. When reply_q is full the oldest reply is
+        dropped, unless block_on_full_reply_q is set, in which case the
+        thread waits for the consumer.
     """
+    QUEUE_SIZE = 16
 
-    def __init__(self, cmd_q=None, reply_q=None):
+    def __init__(self, cmd_q=None, reply_q=None, buffer_pool=None):
         super(SocketClientThread, self).__init__()
-        self.cmd_q = cmd_q or Queue.Queue()
-        self.reply_q = reply_q or Queue.Queue()
+        self.cmd_q = cmd_q or Queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.reply_q = reply_q or Queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.block_on_full_reply_q = False
+        self.dropped_replies = 0
+        self.buffer_pool = buffer_pool or BufferPool()
         self.alive = threading.Event()
         self.alive.set()
         self.socket = None
@@ -92,23 +104,41 @@ class SocketClientThread(threading.Thread):
             self.socket = socket.socket(
                 socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((cmd.data[0], cmd.data[1]))
-            self.reply_q.put(self._success_reply())
+            self._put_reply(self._success_reply())
         except IOError as e:
-            self.reply_q.put(self._error_reply(str(e)))
+            self._put_reply(self._error_reply(str(e)))
 
     def _handle_CLOSE(self, cmd):
         self.socket.close()
         reply = ClientReply(ClientReply.SUCCESS)
-        self.reply_q.put(reply)
+        self._put_reply(reply)
 
     def _handle_SEND(self, cmd):
         try:
-            data_size = struct.pack("!I", len(cmd.data))
-            self.socket.send(data_size)
-            self.socket.sendall(cmd.data)
-            self.reply_q.put(self._success_reply())
+            parts = cmd.data if isinstance(cmd.data, tuple) else (cmd.data,)
+            self._send_message(parts)
+            self._put_reply(self._success_reply())
         except IOError as e:
-            self.reply_q.put(self._error_reply(str(e)))
+            self._put_reply(self._error_reply(str(e)))
+
+    def _send_message(self, parts):
+        """ Sends the length-prefixed concatenation of parts with a single
+            sendall, assembled in a pooled buffer.
+        """
+        parts = [p.reshape(-1) if isinstance(p, np.ndarray)
+                 else np.frombuffer(p, dtype=np.uint8) for p in parts]
+        data_size = sum(p.nbytes for p in parts)
+        buf = self.buffer_pool.acquire_bytes(4 + data_size)
+        try:
+            struct.pack_into("!I", buf, 0, data_size)
+            view = np.frombuffer(buf, dtype=np.uint8)
+            offset = 4
+            for p in parts:
+                view[offset:offset + p.nbytes] = p
+                offset += p.nbytes
+            self.socket.sendall(memoryview(buf)[:offset])
+        finally:
+            self.buffer_pool.release(buf)
 
     def _handle_RECEIVE(self, cmd):
         try:
@@ -117,24 +147,43 @@ class SocketClientThread(threading.Thread):
                 msg_len = struct.unpack('<L', header_data)[0]
                 data = self._recv_n_bytes(msg_len)
                 if len(data) == msg_len:
-                    self.reply_q.put(self._success_reply(data))
+                    self._put_reply(self._success_reply(data))
                     return
-            self.reply_q.put(self._error_reply('Socket closed prematurely'))
+            self._put_reply(self._error_reply('Socket closed prematurely'))
         except IOError as e:
-            self.reply_q.put(self._error_reply(str(e)))
+            self._put_reply(self._error_reply(str(e)))
 
     def _recv_n_bytes(self, n):
         """ Convenience method for receiving exactly n bytes from
             self.socket (assuming it's open and connected).
         """
-        chunks = []
-        while n > 0:
-            chunk = self.socket.recv(n)
-            if chunk == '':
-                break
-            chunks.append(chunk)
-            n -= len(chunk)
-        return ''.join(chunks)
+        buf = self.buffer_pool.acquire_bytes(n)
+        try:
+            view = memoryview(buf)
+            received = 0
+            while received < n:
+                chunk_size = self.socket.recv_into(view[received:n])
+                if chunk_size == 0:
+                    break
+                received += chunk_size
+            return view[:received].tobytes()
+        finally:
+            self.buffer_pool.release(buf)
+
+    def _put_reply(self, reply):
+        if self.block_on_full_reply_q:
+            self.reply_q.put(reply)
+            return
+        while True:
+            try:
+                self.reply_q.put(reply, block=False)
+                return
+            except Queue.Full:
+                try:
+                    self.reply_q.get(block=False)
+                    self.dropped_replies += 1
+                except Queue.Empty:
+                    pass
 
     def _error_reply(self, errstr):
         return ClientReply(ClientReply.ERROR, errstr)
@@ -73,20 +73,26 @@ class ClientThread(QThread, Client):
     def video_frame_callback(self, frame):
         self.sig_video_feed.emit(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
 
-    def response_callback(self, resp_dict):
+    def process_response(self, resp_dict):
+        # image decoding runs on the dispatch workers
         instruction = resp_dict.get('speech', '')
         guidance = resp_dict.get('animation', [])
 
         if len(instruction) > 0 and len(guidance) > 0:
-            logger.info('instruction: {}'.format(instruction))
-
             if len(guidance[-1]) > 0:
                 guidance = b64decode(guidance[-1][0])
                 np_data = np.fromstring(guidance, dtype=np.uint8)
                 frame = cv2.imdecode(np_data, cv2.CV_LOAD_IMAGE_COLOR)
                 guidance = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
-                self.sig_guidance_feed.emit(guidance, instruction)
+                return guidance, instruction
+        return None
+
+    def response_callback(self, guidance):
+        if guidance is not None:
+            image, instruction = guidance
+            logger.info('instruction: {}'.format(instruction))
+            self.sig_guidance_feed.emit(image, instruction)
 
     def run(self):
         # countdown before starting the experiment